@@ -1,6 +1,12 @@
 import logging
-import json
+import orjson
 import asyncio
+import base64
+import functools
+import io
+import os
+
+from PIL import Image
 
 from livekit import rtc
 from livekit.agents.llm import ChatMessage, ChatImage
@@ -18,113 +24,383 @@ from livekit.agents import (
 from livekit.agents.pipeline import VoicePipelineAgent
 from livekit.plugins import openai, deepgram, silero, turn_detector
 
-load_dotenv(dotenv_path=".env.local")
 logger = logging.getLogger("voice-agent")
 
+# Set at import so job processes, which load this module as __mp_main__, also use uvloop
+try:
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    # uvloop is not available on Windows, fall back to the default loop
+    pass
+
+# Speech backends selectable with the AGENT_STT / AGENT_TTS environment variables
+SPEECH_BACKENDS = ("deepgram", "azure")
+
+# Longest edge of the images sent to the LLM; larger frames only cost more vision tokens
+MAX_IMAGE_SIZE = 512
+
+# Seconds before_llm_cb waits for a fresh frame before falling back to the previous one
+IMAGE_TIMEOUT = 0.2
+
+SYSTEM_PROMPT = (
+    "You are a voice assistant created by LiveKit that can both see and hear. "
+    "You should use short and concise responses, avoiding unpronounceable punctuation. "
+    "When you see an image in our conversation, naturally incorporate what you see "
+    "into your response. Keep visual descriptions brief but informative."
+)
+
+def get_speech_backends():
+    """Read the AGENT_STT / AGENT_TTS backend names, raising if either is unsupported."""
+    stt_backend = os.getenv("AGENT_STT", "deepgram")
+    tts_backend = os.getenv("AGENT_TTS", "deepgram")
+    for var, backend in (("AGENT_STT", stt_backend), ("AGENT_TTS", tts_backend)):
+        if backend not in SPEECH_BACKENDS:
+            raise ValueError(
+                f"Unsupported {var}={backend!r}, expected one of: {', '.join(SPEECH_BACKENDS)}"
+            )
+    return stt_backend, tts_backend
+
+def load_speech_factories():
+    """Return the STT and TTS factories for the configured backends."""
+    stt_backend, tts_backend = get_speech_backends()
+    stt_factory, tts_factory = deepgram.STT, deepgram.TTS
+    if "azure" in (stt_backend, tts_backend):
+        # Only import the Azure plugin when it is used; plugins must register on the main thread
+        from livekit.plugins import azure
+        from functions import get_tts as get_azure_tts
+
+        if stt_backend == "azure":
+            stt_factory = azure.STT
+        if tts_backend == "azure":
+            tts_factory = get_azure_tts
+    return stt_factory, tts_factory
+
 def prewarm(proc: JobProcess):
     proc.userdata["vad"] = silero.VAD.load()
+    proc.userdata["stt_factory"], proc.userdata["tts_factory"] = load_speech_factories()
 
 async def get_video_track(room: rtc.Room):
     """Find and return the first available remote video track in the room."""
-    for participant_id, participant in room.remote_participants.items():
-        for track_id, track_publication in participant.track_publications.items():
-            if track_publication.track and isinstance(
-                track_publication.track, rtc.RemoteVideoTrack
-            ):
-                logger.info(
-                    f"Found video track {track_publication.track.sid} "
-                    f"from participant {participant_id}"
-                )
-                return track_publication.track
-    raise ValueError("No remote video track found in the room")
-
-async def get_latest_image(room: rtc.Room):
-    """Capture and return a single frame from the video track."""
-    video_stream = None
+    found = next(
+        (
+            (participant.identity, track_publication.track)
+            for participant in room.remote_participants.values()
+            for track_publication in participant.track_publications.values()
+            if isinstance(track_publication.track, rtc.RemoteVideoTrack)
+        ),
+        None,
+    )
+    if found is None:
+        raise ValueError("No remote video track found in the room")
+    participant_id, video_track = found
+    logger.info(
+        "Found video track %s from participant %s", video_track.sid, participant_id
+    )
+    return video_track
+
+def clear_latest_frame(proc: JobProcess):
+    """Drop the cached frame and the image prepared from it."""
+    for key in (
+        "latest_frame",
+        "last_frame",
+        "last_img_hash",
+        "last_chat_image",
+        "image_prep",
+    ):
+        proc.userdata.pop(key, None)
+
+async def frame_pump(proc: JobProcess, video_track: rtc.RemoteVideoTrack):
+    """Keep the most recent frame of the video track in the process userdata."""
+    # Only the newest frame is kept, so let the stream drop stale ones instead of queueing them
+    video_stream = rtc.VideoStream(video_track, capacity=1)
     try:
-        video_track = await get_video_track(room)
-        video_stream = rtc.VideoStream(video_track)
         async for event in video_stream:
-            logger.debug("Captured latest video frame")
-            return event.frame
+            proc.userdata["latest_frame"] = event.frame
     except Exception as e:
-        logger.error(f"Failed to get latest image: {e}")
+        logger.error("Frame pump for track %s stopped: %s", video_track.sid, e)
+    finally:
+        # A pump replaced by a newer one must not clear its successor's frame
+        if proc.userdata.get("frame_pump") is asyncio.current_task():
+            proc.userdata.pop("frame_pump")
+            clear_latest_frame(proc)
+        await video_stream.aclose()
+
+def get_latest_image(proc: JobProcess):
+    """Return the latest frame captured by the frame pump, if any."""
+    return proc.userdata.get("latest_frame")
+
+def frame_to_image(frame: rtc.VideoFrame):
+    """Convert a video frame to an RGBA image, downscaled to MAX_IMAGE_SIZE."""
+    rgba_frame = frame.convert(rtc.VideoBufferType.RGBA)
+    # Share the converted frame buffer; the only full-resolution copy is made by convert()
+    image = Image.frombuffer(
+        "RGBA",
+        (rgba_frame.width, rgba_frame.height),
+        memoryview(rgba_frame.data),
+        "raw",
+        "RGBA",
+        0,
+        1,
+    )
+    width, height = image.size
+    logger.debug("Captured image: width=%d, height=%d", width, height)
+    scale = MAX_IMAGE_SIZE / max(width, height)
+    if scale < 1:
+        image = image.resize(
+            (int(width * scale), int(height * scale)), Image.BILINEAR
+        )
+    return image
+
+def image_hash(frame: rtc.VideoFrame):
+    """Hash a 32x32 thumbnail of the frame's luma plane so near-identical scenes compare equal."""
+    # I420, I420A and NV12 buffers all start with a full-resolution Y plane
+    if frame.type not in (
+        rtc.VideoBufferType.I420,
+        rtc.VideoBufferType.I420A,
+        rtc.VideoBufferType.NV12,
+    ):
+        frame = frame.convert(rtc.VideoBufferType.I420)
+    width, height = frame.width, frame.height
+    luma = Image.frombuffer(
+        "L", (width, height), memoryview(frame.data)[: width * height], "raw", "L", 0, 1
+    )
+    thumb = luma.resize((32, 32), Image.BILINEAR)
+    # Quantize to 16 levels so sensor noise doesn't change the hash of a static scene
+    return hash(thumb.point(lambda v: v >> 4).tobytes())
+
+def encode_jpeg(image: Image.Image, quality=60):
+    """Encode an image as a base64 JPEG data URL."""
+    buf = io.BytesIO()
+    # JPEG has no alpha channel; drop it here, after the image has been downscaled
+    image.convert("RGB").save(buf, "JPEG", quality=quality)
+    return f"data:image/jpeg;base64,{base64.b64encode(buf.getvalue()).decode()}"
+
+def prepare_image(frame: rtc.VideoFrame, last_hash=None):
+    """Return the frame hash and its JPEG encoding, or None if the hash is unchanged."""
+    frame_hash = image_hash(frame)
+    if frame_hash == last_hash:
+        return frame_hash, None
+    return frame_hash, encode_jpeg(frame_to_image(frame))
+
+def parse_metadata(participant):
+    """Parse the participant metadata, returning None if it is missing or invalid."""
+    if not participant.metadata:
         return None
+    try:
+        metadata = orjson.loads(participant.metadata)
+    except (orjson.JSONDecodeError, ValueError) as e:
+        logger.error("❌ Failed to parse metadata for %s: %s", participant.identity, e)
+        return None
+    selected_person = metadata.get("selectedPerson", "Unknown")
+    bot_name = metadata.get("botName", "VoiceBot")
+    return selected_person, bot_name
+
+async def wait_for_metadata(room: rtc.Room, participant, timeout=15.0, check_current=True):
+    """Waits for metadata to be available for a participant.
+
+    With check_current=False, the metadata the participant already has is ignored
+    and only the next metadata update is used.
+    """
+    fut = asyncio.get_running_loop().create_future()
+
+    def on_metadata_changed(p: rtc.Participant, old_metadata: str, new_metadata: str):
+        if p.identity != participant.identity or fut.done():
+            return
+        result = parse_metadata(p)
+        if result:
+            fut.set_result(result)
+
+    room.on("participant_metadata_changed", on_metadata_changed)
+    try:
+        # The metadata may have arrived before the handler was registered
+        result = parse_metadata(participant) if check_current else None
+        if result:
+            fut.set_result(result)
+
+        logger.info("⏳ Waiting for metadata from %s...", participant.identity)
+        selected_person, bot_name = await asyncio.wait_for(fut, timeout=timeout)
+        logger.info(
+            "✅ Metadata found for %s: %s, Bot Name: %s",
+            participant.identity,
+            selected_person,
+            bot_name,
+        )
+        return selected_person, bot_name
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ Metadata not found after %ss. Using defaults.", timeout)
+        return "Unknown", "VoiceBot"
     finally:
-        if video_stream:
-            await video_stream.aclose()
-
-async def wait_for_metadata(participant, max_retries=10, delay=1.5):
-    """Waits for metadata to be available for a participant."""
-    for attempt in range(max_retries):
-        if participant.metadata:
-            try:
-                metadata = json.loads(participant.metadata)
-                selected_person = metadata.get("selectedPerson", "Unknown")
-                bot_name = metadata.get("botName", "VoiceBot")
-                logger.info(f"✅ Metadata found for {participant.identity}: {selected_person}, Bot Name: {bot_name}")
-                return selected_person, bot_name
-            except json.JSONDecodeError as e:
-                logger.error(f"❌ Failed to parse metadata for {participant.identity}: {e}")
-        
-        logger.info(f"⏳ Waiting for metadata... Attempt {attempt + 1}/{max_retries}")
-        await asyncio.sleep(delay)
-
-    logger.warning(f"⚠️ Metadata not found after {max_retries} retries. Using defaults.")
-    return "Unknown", "VoiceBot"
-
-async def fetch_metadata_again(ctx, participant, retry_after=5):
-    """Fetch metadata again after waiting for some time."""
-    await asyncio.sleep(retry_after)
+        room.off("participant_metadata_changed", on_metadata_changed)
+
+async def fetch_metadata_again(ctx, participant, timeout=10.0):
+    """Fetch metadata again, waiting for a late metadata update."""
     logger.info("🔄 Fetching participant metadata again after initial failure...")
-    return await wait_for_metadata(participant, max_retries=5, delay=2.0)
+    # Metadata that parsed but had no selectedPerson would just be read again, so
+    # only look at the current metadata if the first wait saw none at all
+    check_current = parse_metadata(participant) is None
+    return await wait_for_metadata(
+        ctx.room, participant, timeout=timeout, check_current=check_current
+    )
 
 async def entrypoint(ctx: JobContext):
+    def on_image_prepared(prep: asyncio.Future, frame: rtc.VideoFrame):
+        """Store a finished image preparation, even if the turn that started it timed out."""
+        userdata = ctx.proc.userdata
+        # Dropped by clear_latest_frame, e.g. the track went away while preparing
+        if userdata.get("image_prep") is not prep:
+            return
+        userdata.pop("image_prep")
+        if prep.cancelled():
+            return
+        if prep.exception():
+            logger.error("Failed to prepare the latest frame: %s", prep.exception())
+            return
+        frame_hash, jpeg = prep.result()
+        userdata["last_frame"] = frame
+        if jpeg:
+            userdata["last_img_hash"] = frame_hash
+            userdata["last_chat_image"] = ChatImage(image=jpeg)
+        else:
+            logger.debug("Scene unchanged, reusing previous image")
+
+    async def capture_image():
+        """Return a ChatImage of the latest frame, reusing the previous one if unchanged."""
+        userdata = ctx.proc.userdata
+        latest_image = get_latest_image(ctx.proc)
+        if latest_image is None:
+            return None
+        # The pump replaces the frame on every delivered frame, so this only hits
+        # when the camera has stopped sending (e.g. muted or paused)
+        if latest_image is userdata.get("last_frame"):
+            logger.debug("No new frame since last turn, reusing previous image")
+            return userdata.get("last_chat_image")
+
+        # Reuse a preparation still running from a timed-out turn instead of starting another
+        prep = userdata.get("image_prep")
+        if prep is None:
+            loop = asyncio.get_running_loop()
+            prep = loop.run_in_executor(
+                None, prepare_image, latest_image, userdata.get("last_img_hash")
+            )
+            userdata["image_prep"] = prep
+            prep.add_done_callback(functools.partial(on_image_prepared, frame=latest_image))
+        try:
+            # Shielded so a timeout only stops waiting; the result still fills the cache
+            await asyncio.shield(prep)
+        except Exception:
+            # Logged by on_image_prepared
+            pass
+        return userdata.get("last_chat_image")
+
     async def before_llm_cb(assistant: VoicePipelineAgent, chat_ctx: llm.ChatContext):
         """Callback that runs before LLM generates a response, capturing video frames."""
-        latest_image = await get_latest_image(ctx.room)
-        if latest_image:
-            image_content = [ChatImage(image=latest_image)]
-            chat_ctx.messages.append(ChatMessage(role="user", content=image_content))
+        try:
+            chat_image = await asyncio.wait_for(capture_image(), timeout=IMAGE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out preparing the latest frame, using the previous one")
+            chat_image = ctx.proc.userdata.get("last_chat_image")
+        if chat_image:
+            chat_ctx.messages.append(ChatMessage(role="user", content=[chat_image]))
             logger.debug("Added latest frame to conversation context")
 
-    initial_ctx = llm.ChatContext().append(
-        role="system",
-        text=(
-            "You are a voice assistant created by LiveKit that can both see and hear. "
-            "You should use short and concise responses, avoiding unpronounceable punctuation. "
-            "When you see an image in our conversation, naturally incorporate what you see "
-            "into your response. Keep visual descriptions brief but informative."
-        ),
-    )
+    initial_ctx = llm.ChatContext().append(role="system", text=SYSTEM_PROMPT)
 
-    logger.info(f"🔗 Connecting to room {ctx.room.name}")
+    logger.info("🔗 Connecting to room %s", ctx.room.name)
     await ctx.connect(auto_subscribe=AutoSubscribe.SUBSCRIBE_ALL)
+
+    pump_track_sid = None
+
+    def stop_frame_pump():
+        pump_task = ctx.proc.userdata.pop("frame_pump", None)
+        if pump_task:
+            pump_task.cancel()
+        clear_latest_frame(ctx.proc)
+
+    def start_frame_pump(video_track: rtc.RemoteVideoTrack):
+        nonlocal pump_track_sid
+        stop_frame_pump()
+        pump_track_sid = video_track.sid
+        ctx.proc.userdata["frame_pump"] = asyncio.create_task(
+            frame_pump(ctx.proc, video_track)
+        )
+
+    @ctx.room.on("track_subscribed")
+    def on_track_subscribed(
+        track: rtc.Track,
+        publication: rtc.RemoteTrackPublication,
+        participant: rtc.RemoteParticipant,
+    ):
+        if isinstance(track, rtc.RemoteVideoTrack):
+            logger.info("Video track %s subscribed, restarting frame pump", track.sid)
+            start_frame_pump(track)
+
+    @ctx.room.on("track_unsubscribed")
+    def on_track_unsubscribed(
+        track: rtc.Track,
+        publication: rtc.RemoteTrackPublication,
+        participant: rtc.RemoteParticipant,
+    ):
+        if track.sid == pump_track_sid:
+            logger.info("Video track %s unsubscribed, stopping frame pump", track.sid)
+            stop_frame_pump()
+
+    async def on_shutdown():
+        stop_frame_pump()
+
+    ctx.add_shutdown_callback(on_shutdown)
+
+    try:
+        start_frame_pump(await get_video_track(ctx.room))
+    except ValueError:
+        logger.info("No video track yet, frame pump will start on subscription")
     
     if ctx.room.metadata:
-        logger.info(f"Room metadata found: {ctx.room.metadata}")
+        logger.info("Room metadata found: %s", ctx.room.metadata)
         print(f"Room metadata: {ctx.room.metadata}")
     else:
         logger.info("Room metadata is empty.")
         print("Room metadata is empty.")
 
     participant = await ctx.wait_for_participant()
-    logger.info(f"🎙️ Starting voice assistant for participant {participant.identity}")
+    logger.info("🎙️ Starting voice assistant for participant %s", participant.identity)
 
-    selected_person, bot_name = await wait_for_metadata(participant)
+    # Build the pipeline plugins while waiting for metadata so their setup overlaps
+    setup_tasks = [
+        asyncio.ensure_future(coro)
+        for coro in (
+            asyncio.to_thread(ctx.proc.userdata["stt_factory"]),
+            asyncio.to_thread(openai.LLM, model="gpt-4o-mini"),
+            asyncio.to_thread(ctx.proc.userdata["tts_factory"]),
+            # EOUModel binds to the job's inference executor, so it can't be built in
+            # prewarm; the ONNX model itself is already shared by the inference process
+            asyncio.to_thread(turn_detector.EOUModel),
+            wait_for_metadata(ctx.room, participant),
+        )
+    ]
+    try:
+        stt, agent_llm, tts, eou, (selected_person, bot_name) = await asyncio.gather(
+            *setup_tasks
+        )
+    except BaseException:
+        # Don't leave the metadata wait (and its room handler) running after a failed setup
+        for task in setup_tasks:
+            task.cancel()
+        raise
     
     if selected_person == "Unknown":
         selected_person, bot_name = await fetch_metadata_again(ctx, participant)
 
-    logger.info(f"🔹 Final participant metadata: {participant.metadata}")
-    logger.info(f"🆔 Bot is now identified as: {bot_name}")
+    logger.info("🔹 Final participant metadata: %s", participant.metadata)
+    logger.info("🆔 Bot is now identified as: %s", bot_name)
 
     agent = VoicePipelineAgent(
         vad=ctx.proc.userdata["vad"],
-        stt=deepgram.STT(),
-        llm=openai.LLM(model="gpt-4o-mini"),
-        tts=deepgram.TTS(),
-        turn_detector=turn_detector.EOUModel(),
+        stt=stt,
+        llm=agent_llm,
+        tts=tts,
+        turn_detector=eou,
         min_endpointing_delay=0.5,
         max_endpointing_delay=5.0,
         chat_ctx=initial_ctx,
@@ -144,6 +420,9 @@ async def entrypoint(ctx: JobContext):
     await agent.say(greeting_message, allow_interruptions=True)
 
 if __name__ == "__main__":
+    load_dotenv(dotenv_path=".env.local")
+    # Fail fast on a bad backend name instead of in every job
+    get_speech_backends()
     cli.run_app(
         WorkerOptions(
             entrypoint_fnc=entrypoint,
@@ -1,28 +1,26 @@
+import functools
 import logging
 import os
 import asyncio
 from dotenv import load_dotenv
 from livekit.plugins import azure
 
-# Load environment variables
-load_dotenv(dotenv_path=".env.local")
-
-AZURE_TTS_KEY = os.getenv("AZURE_TTS_SUBSCRIPTION_KEY")
-AZURE_TTS_REGION = os.getenv("AZURE_TTS_REGION")
+logger = logging.getLogger("voice-agent")
 
-if not AZURE_TTS_KEY or not AZURE_TTS_REGION:
-    raise ValueError("Azure TTS credentials are missing! Set them in .env.local")
+@functools.lru_cache(maxsize=1)
+def get_tts():
+    """Build the Azure TTS client on first use and reuse it afterwards."""
+    azure_tts_key = os.getenv("AZURE_TTS_SUBSCRIPTION_KEY")
+    azure_tts_region = os.getenv("AZURE_TTS_REGION")
 
-# Setup logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("voice-agent")
+    if not azure_tts_key or not azure_tts_region:
+        raise ValueError("Azure TTS credentials are missing! Set them in .env.local")
 
-# Initialize Azure TTS with credentials
-azure_tts = azure.TTS(
-    voice="en-US-JennyNeural",  # Change if needed
-    subscription_key=AZURE_TTS_KEY,
-    region=AZURE_TTS_REGION
-)
+    return azure.TTS(
+        voice="en-US-JennyNeural",  # Change if needed
+        subscription_key=azure_tts_key,
+        region=azure_tts_region
+    )
 
 async def test_tts():
     """ Test if Azure TTS is working correctly """
@@ -34,13 +32,15 @@ async def test_tts():
     }
 
     for lang, message in test_messages.items():
-        logger.info(f"🔊 Synthesizing {lang} message...")
-        audio = azure_tts.synthesize(message)  # No `await`
+        logger.info("🔊 Synthesizing %s message...", lang)
+        audio = get_tts().synthesize(message)  # No `await`
 
         if isinstance(audio, bytes):
-            logger.info(f"✅ {lang.capitalize()} TTS successful, generated {len(audio)} bytes")
+            logger.info("✅ %s TTS successful, generated %d bytes", lang.capitalize(), len(audio))
         else:
-            logger.error(f"❌ {lang.capitalize()} TTS failed")
+            logger.error("❌ %s TTS failed", lang.capitalize())
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv(dotenv_path=".env.local")
     asyncio.run(test_tts())